@@ -1,11 +1,26 @@
 import numpy as np
-import numpy.lib.recfunctions as rfn
 from collections import defaultdict
 import json
 
 from h5flow.core import H5FlowStage, resources
 
 
+
+def _any_field_mask(mask):
+    '''
+        OR-reduce a structured mask across its fields without making an
+        unstructured copy
+
+        :param mask: structured boolean array, ``shape: (N,M)``
+
+        :returns: boolean array, ``shape: (N,M)``
+    '''
+    out = np.zeros(mask.shape, dtype=bool)
+    for name in mask.dtype.names:
+        np.logical_or(out, mask[name], out=out)
+    return out
+
+
 class CalibHitBuilder(H5FlowStage):
     '''
         Converts larpix data packets into hits - assigns geometric properties,
@@ -23,6 +38,9 @@ class CalibHitBuilder(H5FlowStage):
          - ``ts_dset_name`` : ``str``, required, input dataset path for clock-corrected packet timestamps
          - ``pedestal_file`` : ``str``, optional, path to a pedestal json file
          - ``configuration_file`` : ``str``, optional, path to a vref/vcm config json file
+         - ``buffer_writes`` : ``bool``, optional, hold blocks of less than half an HDF5 chunk and
+           write them out at chunk boundaries (default: ``False``). Do not enable if a later stage
+           in the same workflow reads the output dataset.
 
         ``packets_dset_name``, ``ts_dset_name``, and ``packets_index_name`` are required in
         the data cache. ``packets_index_name`` must point to the index for ``packets_dset_name``.
@@ -59,7 +77,7 @@ class CalibHitBuilder(H5FlowStage):
             E              f8, hit energy [MeV]
 
     '''
-    class_version = '1.0.0'
+    class_version = '1.0.1'
 
     #: ASIC ADC configuration lookup table
     configuration = defaultdict(lambda: dict(
@@ -72,6 +90,13 @@ class CalibHitBuilder(H5FlowStage):
         pedestal_mv=580
     ))
 
+    #: per-channel ADC calibration constants, as stored in ``configuration`` and ``pedestal``
+    channel_calib_dtype = np.dtype([
+        ('vref_mv', 'f8'),
+        ('vcm_mv', 'f8'),
+        ('pedestal_mv', 'f8')
+    ])
+
     calib_hits_dtype = np.dtype([
         ('id', 'u4'),
         ('x', 'f8'),
@@ -94,11 +119,16 @@ class CalibHitBuilder(H5FlowStage):
         self.t0_dset_name = params.get('t0_dset_name')
         self.pedestal_file = params.get('pedestal_file', '')
         self.configuration_file = params.get('configuration_file', '')
+        self.buffer_writes = params.get('buffer_writes', False)
 
     def init(self, source_name):
         super(CalibHitBuilder, self).init(source_name)
         self.load_pedestals()
         self.load_configurations()
+        self._calib_keys, self._calib_values = self._build_calib_lut()
+
+        # drift distance per tick of drift time
+        self._drift_scale = float(resources['LArData'].v_drift * resources['RunData'].crs_ticks)
 
         # save all config info
         self.data_manager.set_attrs(self.calib_hits_dset_name,
@@ -117,6 +147,11 @@ class CalibHitBuilder(H5FlowStage):
         self.data_manager.create_ref(self.calib_hits_dset_name, self.packets_dset_name)
         self.data_manager.create_ref(self.events_dset_name, self.calib_hits_dset_name)
 
+        # pending (slice, array) writes, flushed once a full HDF5 chunk is available
+        self._write_buffer = []
+        if self.buffer_writes:
+            self._write_buffer_rows = self.data_manager.get_dset(self.calib_hits_dset_name).chunks[0]
+
     def run(self, source_name, source_slice, cache):
         super(CalibHitBuilder, self).run(source_name, source_slice, cache)
         events_data = cache[self.events_dset_name]
@@ -125,15 +160,21 @@ class CalibHitBuilder(H5FlowStage):
         t0_data = cache[self.t0_dset_name]
         raw_hits = cache[self.raw_hits_dset_name]
 
-        mask = ~rfn.structured_to_unstructured(packets_data.mask).any(axis=-1)
-        rh_mask = ~rfn.structured_to_unstructured(raw_hits.mask).any(axis=-1)
+        mask = ~_any_field_mask(packets_data.mask)
+        # raw hit records are masked as a whole, so the id field is sufficient
+        rh_mask = ~raw_hits.mask['id']
+
+        # cached data is already in memory, so apply all selections to the
+        # underlying arrays rather than through the masked array interface
+        packets_data_arr = packets_data.data
 
         # get event boundaries
         if np.count_nonzero(mask):
-            raw_hits_arr = raw_hits.data[rh_mask]
-            mask = (packets_data['packet_type'] == 0) & mask
+            # only the timestamp is needed from the raw hits
+            ts_pps_arr = raw_hits.data['ts_pps'][rh_mask]
+            mask &= packets_data_arr['packet_type'] == 0
             n = np.count_nonzero(mask)
-            packets_arr = packets_data.data[mask]
+            packets_arr = packets_data_arr[mask]
             #index_arr = packets_index.data[mask]
         else:
             n = 0
@@ -143,7 +184,7 @@ class CalibHitBuilder(H5FlowStage):
         calib_hits_slice = self.data_manager.reserve_data(self.calib_hits_dset_name, n)
 
         # convert to hits array
-        calib_hits_arr = np.zeros((n,), dtype=self.calib_hits_dtype)
+        calib_hits_arr = np.empty((n,), dtype=self.calib_hits_dtype)
         if n:
 
             # For now, use the event time as the t0 for each hit
@@ -152,56 +193,44 @@ class CalibHitBuilder(H5FlowStage):
             # Given optical pileup, we can have multiple triggers
             # per event. There is probably a cleaner way to use h5flow
             # associations, but for now this will do...
-            hit_t0 = np.full(len(raw_hits_arr['ts_pps']),0)
-
             if not len(raw_hits) == len(t0_data['ts']):
-                print("event dividers for raw hits and t0 inconsistent")
-                exit
-            else:
-                first_index = 0
-                for t0_it, t0 in enumerate(t0_data['ts']):
-                    n_masked = np.ma.count_masked(raw_hits[t0_it]['id'],axis=0)
-                    n_not_masked = len(raw_hits[t0_it]['id']) - n_masked
-                    last_index = first_index + n_not_masked
-                    print(t0_it,n_not_masked,first_index,first_index+n_not_masked,t0)
-                    hit_t0[first_index:last_index] = np.full(n_not_masked,t0)
-                    first_index += n_not_masked
-
-            drift_t = raw_hits_arr['ts_pps'] - hit_t0
-
-            drift_d = drift_t * (resources['LArData'].v_drift * resources['RunData'].crs_ticks)
+                raise RuntimeError(f'event dividers for raw hits ({len(raw_hits)}) and t0 ({len(t0_data["ts"])}) inconsistent')
+            n_hits = np.count_nonzero(rh_mask, axis=-1)
+            hit_t0 = np.repeat(t0_data['ts'].data.ravel(), n_hits)
+
+            drift_t = ts_pps_arr - hit_t0
+
+            drift_d = drift_t * self._drift_scale
             z = resources['Geometry'].get_z_coordinate(packets_arr['io_group'],packets_arr['io_channel'],drift_d)
 
             xy = resources['Geometry'].pixel_xy[packets_arr['io_group'],
                                                 packets_arr['io_channel'], packets_arr['chip_id'], packets_arr['channel_id']]
-            tile_id = resources['Geometry'].tile_id[packets_arr['io_group'],packets_arr['io_channel']]
-            hit_uniqueid = (((packets_arr['io_group'].astype(int)) * 100000
-                             + packets_arr['io_channel'].astype(int)) * 1000
-                            + packets_arr['chip_id'].astype(int)) * 64 \
-                + packets_arr['channel_id'].astype(int)
-            hit_uniqueid_str = hit_uniqueid.astype(str)
-            vref = np.array(
-                [self.configuration[unique_id]['vref_mv'] for unique_id in hit_uniqueid_str])
-            vcm = np.array([self.configuration[unique_id]['vcm_mv']
-                            for unique_id in hit_uniqueid_str])
-            ped = np.array([self.pedestal[unique_id]['pedestal_mv']
-                            for unique_id in hit_uniqueid_str])
+            calib_idx = self._lut_index(self._calib_keys, self._unique_id(
+                packets_arr['io_group'], packets_arr['io_channel'], packets_arr['chip_id'], packets_arr['channel_id']))
+            vref = self._calib_values['vref_mv'][calib_idx]
+            # vref is a fresh contiguous gather, so it can be overwritten with the charge
+            q = self.charge_from_dataword(packets_arr['dataword'], vref, self._calib_values['vcm_mv'][calib_idx],
+                                          self._calib_values['pedestal_mv'][calib_idx], out=vref)
+
+            # each field is filled with a single vectorized assignment (the xy columns are strided views)
             calib_hits_arr['id'] = calib_hits_slice.start + np.arange(n, dtype=int)
             # NOTE: swapping x <--> z coordinates so the z is ~ in the beam direction
             calib_hits_arr['x'] = z
             calib_hits_arr['y'] = xy[:,1]
             calib_hits_arr['z'] = xy[:,0]
-            calib_hits_arr['ts_pps'] = raw_hits_arr['ts_pps']
+            calib_hits_arr['ts_pps'] = ts_pps_arr
             calib_hits_arr['t_drift'] = drift_t
-            calib_hits_arr['Q'] = self.charge_from_dataword(packets_arr['dataword'],vref,vcm,ped)
-            calib_hits_arr['E'] = self.charge_from_dataword(packets_arr['dataword'],vref,vcm,ped) * 23.6e-6 # hardcoding W_ion and not accounting for finite electron lifetime
+            calib_hits_arr['Q'] = q
+            np.multiply(q, 23.6e-6, out=calib_hits_arr['E']) # hardcoding W_ion and not accounting for finite electron lifetime
 
         # write
-        self.data_manager.write_data(self.calib_hits_dset_name, calib_hits_slice, calib_hits_arr)
+        self.write_calib_hits(calib_hits_slice, calib_hits_arr)
 
         # save references
-        raw_ev_id = np.broadcast_to(np.expand_dims(np.r_[source_slice], axis=-1), packets_data.shape)
-        ref = np.c_[raw_ev_id[mask], calib_hits_arr['id']]
+        # row of each selected packet is its position within the source slice
+        ref = np.empty((n, 2), dtype='i8')
+        np.add(np.nonzero(mask)[0], source_slice.start, out=ref[:, 0])
+        ref[:, 1] = calib_hits_arr['id']
         # raw_event -> hit
         self.data_manager.write_ref(source_name, self.calib_hits_dset_name, ref)
 
@@ -212,9 +241,133 @@ class CalibHitBuilder(H5FlowStage):
         #ref = np.c_[calib_hits_arr['id'], index_arr]
         #self.data_manager.write_ref(self.calib_hits_dset_name, self.packets_dset_name, ref)
 
+    def finish(self, source_name):
+        super(CalibHitBuilder, self).finish(source_name)
+        self.flush_calib_hits()
+
+    def write_calib_hits(self, calib_hits_slice, calib_hits_arr):
+        '''
+            Write calibrated hits to the output dataset. If ``buffer_writes``
+            is enabled, blocks of less than half an HDF5 chunk are buffered and
+            only written up to the last chunk boundary they reach, with the
+            remainder kept for the next call. Larger blocks first complete any
+            partially buffered chunk and are then written directly.
+        '''
+        if not self.buffer_writes:
+            self.data_manager.write_data(self.calib_hits_dset_name, calib_hits_slice, calib_hits_arr)
+            return
+        if not len(calib_hits_arr):
+            return
+
+        # slices reserved by other processes break contiguity
+        if self._write_buffer and self._write_buffer[-1][0].stop != calib_hits_slice.start:
+            self.flush_calib_hits()
+
+        rows = self._write_buffer_rows
+        start = self._write_buffer[0][0].start if self._write_buffer else calib_hits_slice.start
+        if len(calib_hits_arr) >= rows // 2:
+            if self._write_buffer:
+                # the buffer never spans a chunk boundary, so this is less than one chunk
+                n_head = min((start // rows + 1) * rows - calib_hits_slice.start, len(calib_hits_arr))
+                self._write_buffer.append((slice(calib_hits_slice.start, calib_hits_slice.start + n_head),
+                                           calib_hits_arr[:n_head]))
+                self.flush_calib_hits()
+                calib_hits_slice = slice(calib_hits_slice.start + n_head, calib_hits_slice.stop)
+                calib_hits_arr = calib_hits_arr[n_head:]
+            if len(calib_hits_arr):
+                self.data_manager.write_data(self.calib_hits_dset_name, calib_hits_slice, calib_hits_arr)
+            return
+
+        boundary = calib_hits_slice.stop // rows * rows
+        if boundary <= start:
+            self._write_buffer.append((calib_hits_slice, calib_hits_arr))
+            return
+
+        # write up to the last chunk boundary and keep the remainder
+        n_head = boundary - calib_hits_slice.start
+        self._write_buffer.append((slice(calib_hits_slice.start, boundary), calib_hits_arr[:n_head]))
+        self.flush_calib_hits()
+        if n_head < len(calib_hits_arr):
+            self._write_buffer.append((slice(boundary, calib_hits_slice.stop), calib_hits_arr[n_head:]))
+
+    def flush_calib_hits(self):
+        '''
+            Write out any buffered calibrated hits
+        '''
+        if not self._write_buffer:
+            return
+        buffer_slice = slice(self._write_buffer[0][0].start, self._write_buffer[-1][0].stop)
+        if len(self._write_buffer) == 1:
+            buffer_arr = self._write_buffer[0][1]
+        else:
+            buffer_arr = np.concatenate([arr for _, arr in self._write_buffer])
+        self.data_manager.write_data(self.calib_hits_dset_name, buffer_slice, buffer_arr)
+        self._write_buffer = []
+
+    @staticmethod
+    def charge_from_dataword(dw, vref, vcm, ped, out=None):
+        # evaluated in place on a single buffer to avoid allocating a new array per operation,
+        # an existing ``f8`` array can be passed as ``out`` to skip the allocation entirely
+        q = np.subtract(vref, vcm, out=out, dtype='f8')
+        q *= dw
+        q /= 256.
+        q += vcm
+        q -= ped
+        q /= 4. # hardcoding 1 ke/mV conv.
+        return q
+
+    @staticmethod
+    def _unique_id(io_group, io_channel, chip_id, channel_id):
+        '''
+            Pack channel addresses into the pedestal and configuration file keys,
+            ``((io_group * 100000 + io_channel) * 1000 + chip_id) * 64 + channel_id``
+        '''
+        unique_id = np.array(io_group, dtype='i8')
+        unique_id *= 100000
+        unique_id += io_channel
+        unique_id *= 1000
+        unique_id += chip_id
+        unique_id *= 64
+        unique_id += channel_id
+        return unique_id
+
     @staticmethod
-    def charge_from_dataword(dw, vref, vcm, ped):
-        return (dw / 256. * (vref - vcm) + vcm - ped) / 4. # hardcoding 1 ke/mV conv.
+    def _lut_index(keys, unique_id):
+        '''
+            Find the position of each ``unique_id`` in the sorted ``keys``, ids
+            that are not present map to the trailing default entry
+        '''
+        idx = np.searchsorted(keys, unique_id)
+        idx[keys[idx] != unique_id] = len(keys) - 1
+        return idx
+
+    def _build_calib_lut(self):
+        '''
+            Collect the ``configuration`` and ``pedestal`` values of every channel
+            in either table into a sorted table. Channels missing from one of the
+            tables take that table's default value.
+
+            :returns: ``tuple`` of sorted ``i8`` unique ids and ``channel_calib_dtype`` values, both with a trailing entry for channels not in the tables
+        '''
+        config_default = self.configuration.default_factory()
+        ped_default = self.pedestal.default_factory()
+
+        # non-numeric keys never match a channel, so they are skipped
+        file_keys = [key for key in self.pedestal.keys() | self.configuration.keys()
+                     if str(key).isdigit()]
+        file_keys.sort(key=int)
+
+        keys = np.empty(len(file_keys) + 1, dtype='i8')
+        keys[:-1] = [int(key) for key in file_keys]
+        keys[-1] = np.iinfo(keys.dtype).max
+
+        values = np.empty(len(file_keys) + 1, dtype=self.channel_calib_dtype)
+        for field in ('vref_mv', 'vcm_mv'):
+            values[field] = [self.configuration.get(key, config_default)[field] for key in file_keys] \
+                + [config_default[field]]
+        values['pedestal_mv'] = [self.pedestal.get(key, ped_default)['pedestal_mv'] for key in file_keys] \
+            + [ped_default['pedestal_mv']]
+        return keys, values
 
     def load_pedestals(self):
         if self.pedestal_file != '' and not resources['RunData'].is_mc:
@@ -2,6 +2,7 @@ import numpy as np
 import numpy.lib.recfunctions as rfn
 from collections import defaultdict
 import json
+import logging
 
 from h5flow.core import H5FlowStage, resources
 
@@ -148,7 +149,8 @@ class RawHitBuilder(H5FlowStage):
             xy = resources['Geometry'].pixel_xy[packets_arr['io_group'],
                                                 packets_arr['io_channel'], packets_arr['chip_id'], packets_arr['channel_id']]
             tile_id = resources['Geometry'].tile_id[packets_arr['io_group'],packets_arr['io_channel']]
-            print(min(tile_id), max(tile_id))
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug(f'tile_id range: {tile_id.min()}-{tile_id.max()}')
             z = resources['Geometry'].anode_z[(tile_id,)]
 
             raw_hits_arr['id'] = raw_hits_slice.start + np.arange(n, dtype=int)
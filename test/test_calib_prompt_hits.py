@@ -0,0 +1,274 @@
+import pytest
+import numpy as np
+from collections import defaultdict
+from types import SimpleNamespace
+
+from proto_nd_flow.reco.charge import calib_prompt_hits
+from proto_nd_flow.reco.charge.calib_prompt_hits import CalibHitBuilder
+
+
+class DataManagerStub(object):
+    chunks = (100,)
+
+    def __init__(self):
+        self.dsets = dict()
+        self.n = 0
+        self.writes = []
+        self.refs = []
+
+    def set_attrs(self, name, **attrs):
+        pass
+
+    def create_dset(self, name, dtype):
+        self.dsets[name] = SimpleNamespace(dtype=dtype, chunks=self.chunks)
+
+    def create_ref(self, parent_name, child_name):
+        pass
+
+    def get_dset(self, name):
+        return self.dsets[name]
+
+    def reserve_data(self, name, n):
+        spec = slice(self.n, self.n + n)
+        self.n += n
+        return spec
+
+    def write_data(self, name, spec, data):
+        self.writes.append((spec, data))
+
+    def write_ref(self, parent_name, child_name, ref):
+        self.refs.append((parent_name, child_name, np.array(ref)))
+
+
+class PixelXYStub(object):
+    def __getitem__(self, key):
+        io_group, io_channel, chip_id, channel_id = key
+        return np.stack([channel_id * 4., chip_id * 4.], axis=-1)
+
+
+@pytest.fixture
+def stub_resources(monkeypatch):
+    resources = calib_prompt_hits.resources
+    monkeypatch.setitem(resources, 'RunData', SimpleNamespace(is_mc=False, crs_ticks=0.1))
+    monkeypatch.setitem(resources, 'LArData', SimpleNamespace(v_drift=1.6))
+    monkeypatch.setitem(resources, 'Geometry', SimpleNamespace(
+        pixel_xy=PixelXYStub(),
+        get_z_coordinate=lambda io_group, io_channel, drift: io_group * 1000. + drift))
+    return resources
+
+
+@pytest.fixture
+def calib_hit_builder():
+    builder = CalibHitBuilder(name='calib_hit_builder', classname='CalibHitBuilder',
+                              data_manager=DataManagerStub(), requires=[],
+                              events_dset_name='charge/events',
+                              raw_hits_dset_name='charge/raw_hits',
+                              calib_hits_dset_name='charge/calib_prompt_hits',
+                              packets_dset_name='charge/packets',
+                              t0_dset_name='combined/t0')
+    # avoid modifying the class-level tables
+    builder.configuration = defaultdict(CalibHitBuilder.configuration.default_factory)
+    builder.pedestal = defaultdict(CalibHitBuilder.pedestal.default_factory)
+    return builder
+
+
+def file_key(io_group, io_channel, chip_id, channel_id):
+    return ((io_group * 100000 + io_channel) * 1000 + chip_id) * 64 + channel_id
+
+
+@pytest.fixture
+def channels():
+    io_group, io_channel, chip_id, channel_id = np.meshgrid(
+        np.arange(1, 3), np.arange(1, 5), np.arange(11, 20), np.arange(0, 64, 7), indexing='ij')
+    return tuple(k.ravel() for k in (io_group, io_channel, chip_id, channel_id))
+
+
+def test_unique_id(channels):
+    unique_id = CalibHitBuilder._unique_id(*[k.astype('u1') for k in channels])
+    assert unique_id.dtype == np.dtype('i8')
+    assert np.all(unique_id == file_key(*[k.astype('i8') for k in channels]))
+
+
+def lookup(builder, keys, values, channels):
+    idx = builder._lut_index(keys, builder._unique_id(*channels))
+    return values[idx]
+
+
+def test_calib_lut(calib_hit_builder, channels):
+    rng = np.random.default_rng(0)
+    keys = [str(key) for key in file_key(*[k.astype('i8') for k in channels])]
+    for i, key in enumerate(keys):
+        if i % 3:
+            calib_hit_builder.pedestal[key] = dict(pedestal_mv=rng.uniform(500, 700))
+        if i % 2:
+            calib_hit_builder.configuration[key] = dict(vref_mv=rng.uniform(1200, 1400),
+                                                        vcm_mv=rng.uniform(250, 300))
+    calib_hit_builder.pedestal['not_a_channel'] = dict(pedestal_mv=0.)
+
+    lut_keys, lut_values = calib_hit_builder._build_calib_lut()
+    assert np.all(np.diff(lut_keys) > 0)
+    assert len(lut_keys) == len(keys) - len(keys) // 6 + 1
+    calib = lookup(calib_hit_builder, lut_keys, lut_values, channels)
+
+    config_default = calib_hit_builder.configuration.default_factory()
+    ped_default = calib_hit_builder.pedestal.default_factory()
+    assert np.all(calib['vref_mv'] == [calib_hit_builder.configuration.get(key, config_default)['vref_mv']
+                                       for key in keys])
+    assert np.all(calib['vcm_mv'] == [calib_hit_builder.configuration.get(key, config_default)['vcm_mv']
+                                      for key in keys])
+    assert np.all(calib['pedestal_mv'] == [calib_hit_builder.pedestal.get(key, ped_default)['pedestal_mv']
+                                           for key in keys])
+
+    # channels not present in either file
+    missing = lookup(calib_hit_builder, lut_keys, lut_values, ([2], [4], [20], [63]))
+    assert missing['vref_mv'] == 1300
+    assert missing['vcm_mv'] == 288
+    assert missing['pedestal_mv'] == 580
+
+
+def test_calib_lut_empty(calib_hit_builder, channels):
+    lut_keys, lut_values = calib_hit_builder._build_calib_lut()
+    assert len(lut_keys) == 1
+    calib = lookup(calib_hit_builder, lut_keys, lut_values, channels)
+    assert np.all(calib['vref_mv'] == 1300)
+    assert np.all(calib['vcm_mv'] == 288)
+    assert np.all(calib['pedestal_mv'] == 580)
+
+
+def masked(arr, valid):
+    return np.ma.array(arr, mask=np.broadcast_to(~valid, arr.shape))
+
+
+def make_cache(builder, packet_type, n_raw_hits, t0, rng):
+    packets_dtype = np.dtype([(field, 'u1') for field in (
+        'io_group', 'io_channel', 'chip_id', 'channel_id', 'dataword', 'packet_type')])
+    packets = np.zeros(packet_type.shape, dtype=packets_dtype)
+    packets['io_group'] = rng.integers(1, 3, size=packets.shape)
+    packets['io_channel'] = rng.integers(1, 5, size=packets.shape)
+    packets['chip_id'] = rng.integers(11, 20, size=packets.shape)
+    packets['channel_id'] = rng.integers(0, 64, size=packets.shape)
+    packets['dataword'] = rng.integers(0, 256, size=packets.shape)
+    packets['packet_type'] = np.maximum(packet_type, 0)
+    packets_valid = packet_type >= 0
+
+    raw_hits = np.zeros(packet_type.shape, dtype=np.dtype([('id', 'u4'), ('ts_pps', 'u8')]))
+    raw_hits['ts_pps'] = rng.integers(1000, 2000, size=raw_hits.shape)
+    raw_hits_valid = np.arange(packet_type.shape[-1]) < np.array(n_raw_hits)[:, np.newaxis]
+
+    t0_arr = np.zeros((len(t0), 1), dtype=np.dtype([('ts', 'f8')]))
+    t0_arr['ts'] = np.array(t0)[:, np.newaxis]
+    events_valid = np.ones(len(t0), dtype=bool)
+
+    return {
+        builder.events_dset_name: masked(np.zeros(len(t0), dtype=np.dtype([('id', 'u4')])), events_valid),
+        builder.packets_dset_name: masked(packets, packets_valid),
+        builder.packets_index_name: masked(np.zeros(packet_type.shape, dtype='u4'), packets_valid),
+        builder.raw_hits_dset_name: masked(raw_hits, raw_hits_valid),
+        builder.t0_dset_name: masked(t0_arr, events_valid[:, np.newaxis])
+    }
+
+
+def test_run(calib_hit_builder, stub_resources):
+    rng = np.random.default_rng(0)
+    source_name = 'charge/raw_events'
+    calib_hit_builder.init(source_name)
+    dm = calib_hit_builder.data_manager
+
+    # packet_type of each packet in the event, -1 for a masked packet
+    packet_type = np.array([
+        [0, 4, 0, -1],
+        [-1, -1, -1, -1],  # no valid packets
+        [0, 0, 4, 0]
+    ])
+    t0 = [100.5, 0., 200.25]
+    cache = make_cache(calib_hit_builder, packet_type, [2, 0, 3], t0, rng)
+    source_slice = slice(10, 13)
+    calib_hit_builder.run(source_name, source_slice, cache)
+
+    # source row of each data packet
+    row = np.array([0, 0, 2, 2, 2])
+    packets = cache[calib_hit_builder.packets_dset_name].data[packet_type == 0]
+    raw_hits = cache[calib_hit_builder.raw_hits_dset_name]
+    ts_pps = raw_hits.data['ts_pps'][~raw_hits.mask['id']]
+
+    (spec, calib_hits), = dm.writes
+    assert (spec.start, spec.stop) == (0, 5)
+    assert np.all(calib_hits['id'] == np.arange(5))
+    assert np.all(calib_hits['ts_pps'] == ts_pps)
+    assert np.allclose(calib_hits['t_drift'], ts_pps - np.array(t0)[row])
+    assert np.allclose(calib_hits['x'], packets['io_group'] * 1000. + calib_hits['t_drift'] * 1.6 * 0.1)
+    assert np.all(calib_hits['y'] == packets['chip_id'] * 4.)
+    assert np.all(calib_hits['z'] == packets['channel_id'] * 4.)
+    # no calibration files, so the default configuration and pedestal apply
+    q = ((1300. - 288.) * packets['dataword'] / 256. + 288. - 580.) / 4.
+    assert np.allclose(calib_hits['Q'], q)
+    assert np.allclose(calib_hits['E'], q * 23.6e-6)
+
+    assert [(parent, child) for parent, child, _ in dm.refs] == [
+        (source_name, calib_hit_builder.calib_hits_dset_name),
+        (calib_hit_builder.events_dset_name, calib_hit_builder.calib_hits_dset_name)]
+    for _, _, ref in dm.refs:
+        assert np.all(ref[:, 0] == source_slice.start + row)
+        assert np.all(ref[:, 1] == calib_hits['id'])
+
+    # chunk without any valid packets
+    cache = make_cache(calib_hit_builder, np.full((2, 4), -1), [0, 0], [0., 0.], rng)
+    calib_hit_builder.run(source_name, slice(13, 15), cache)
+    spec, calib_hits = dm.writes[-1]
+    assert (spec.start, spec.stop) == (5, 5)
+    assert len(calib_hits) == 0
+    for _, _, ref in dm.refs[2:]:
+        assert ref.shape == (0, 2)
+
+
+@pytest.fixture
+def buffered_calib_hit_builder(calib_hit_builder, stub_resources):
+    calib_hit_builder.buffer_writes = True
+    calib_hit_builder.init('charge/raw_events')
+    return calib_hit_builder
+
+
+def write_blocks(builder, *slices):
+    for spec in slices:
+        arr = np.zeros((spec.stop - spec.start,), dtype=builder.calib_hits_dtype)
+        arr['id'] = np.arange(spec.start, spec.stop)
+        builder.write_calib_hits(spec, arr)
+
+
+def check_writes(writes):
+    for spec, data in writes:
+        assert np.all(data['id'] == np.arange(spec.start, spec.stop))
+    written = np.concatenate([data['id'] for spec, data in writes])
+    assert len(np.unique(written)) == len(written)
+
+
+def test_buffered_write_alignment(buffered_calib_hit_builder):
+    # buffer size is taken from the chunking of the created dataset
+    assert buffered_calib_hit_builder._write_buffer_rows == DataManagerStub.chunks[0]
+    write_blocks(buffered_calib_hit_builder, *[slice(i, i + 30) for i in range(0, 270, 30)])
+    writes = buffered_calib_hit_builder.data_manager.writes
+    assert [(spec.start, spec.stop) for spec, _ in writes] == [(0, 100), (100, 200)]
+
+    buffered_calib_hit_builder.finish('charge/raw_events')
+    assert [(spec.start, spec.stop) for spec, _ in writes] == [(0, 100), (100, 200), (200, 270)]
+    check_writes(writes)
+
+
+def test_buffered_write_gap(buffered_calib_hit_builder):
+    write_blocks(buffered_calib_hit_builder, slice(0, 30), slice(30, 60), slice(90, 120))
+    writes = buffered_calib_hit_builder.data_manager.writes
+    assert [(spec.start, spec.stop) for spec, _ in writes] == [(0, 60), (90, 100)]
+
+    buffered_calib_hit_builder.finish('charge/raw_events')
+    assert [(spec.start, spec.stop) for spec, _ in writes] == [(0, 60), (90, 100), (100, 120)]
+    check_writes(writes)
+
+
+def test_buffered_write_large_block(buffered_calib_hit_builder):
+    write_blocks(buffered_calib_hit_builder, slice(0, 30), slice(30, 1030))
+    writes = buffered_calib_hit_builder.data_manager.writes
+    assert [(spec.start, spec.stop) for spec, _ in writes] == [(0, 100), (100, 1030)]
+
+    buffered_calib_hit_builder.finish('charge/raw_events')
+    assert len(writes) == 2
+    check_writes(writes)